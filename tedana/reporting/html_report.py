@@ -1,5 +1,6 @@
 """Build HTML reports for tedana."""
 
+import functools
 import logging
 import os
 import re
@@ -9,7 +10,7 @@ from pathlib import Path
 import pandas as pd
 from bokeh import __version__ as bokehversion
 from bokeh import embed, layouts, models
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from pybtex.database.input import bibtex
 from pybtex.plugin import find_plugin
 
@@ -23,102 +24,162 @@ LGR = logging.getLogger("GENERAL")
 APA = find_plugin("pybtex.style.formatting", "apa")()
 HTML = find_plugin("pybtex.backends", "html")()
 
+# Matches latex \citep{key} or \citep{key1,key2} commands, capturing the citekeys
+_CITEP_RE = re.compile(r"\\citep\{([^}]+)\}")
 
+
+class _ReportBytecodeCache(FileSystemBytecodeCache):
+    """On-disk Jinja2 bytecode cache that never makes a report fail.
+
+    The cache directory can be removed or filled up at any time (e.g., by a temporary
+    directory cleaner), so errors while reading or writing bytecode are only logged and
+    the template is compiled in memory instead.
+    """
+
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except OSError:
+            LGR.debug("Could not load cached Jinja2 bytecode", exc_info=True)
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            LGR.debug("Could not save Jinja2 bytecode to the cache", exc_info=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_bytecode_cache():
+    """Create an on-disk cache so compiled templates are reused across tedana runs.
+
+    Jinja2 picks a per-user directory in the system temporary directory and refuses to
+    use it if it is not owned by the current user.
+    If no safe directory can be set up, templates are simply compiled in every process.
+    """
+    try:
+        return _ReportBytecodeCache(pattern="__tedana_jinja2_%s.cache")
+    except (OSError, RuntimeError):
+        LGR.debug("Could not set up a Jinja2 bytecode cache directory", exc_info=True)
+        return None
+
+
+# Jinja2 environment shared by every report, with the template directory as loader.
+# Templates ship with the package and do not change at runtime, so there is no need
+# to check them for modifications on every lookup.
+# The bytecode cache is only attached when the first template is loaded, so importing
+# this module does not create anything on disk.
+_TEMPLATE_ENV = Environment(
+    loader=FileSystemLoader(str(Path(__file__).resolve().parent.joinpath("data", "html"))),
+    auto_reload=False,
+    cache_size=-1,
+)
+
+
+def _cache_while_unchanged(load_file):
+    """Cache the output of ``load_file(path)`` until the file at ``path`` changes.
+
+    The cache is keyed on the path with the file's modification time and size,
+    so the same object is returned for as long as the file is unchanged on disk.
+    It is shared between calls, so it must not be modified.
+    """
+
+    @functools.lru_cache(maxsize=16)
+    def _load_cached(file_key):
+        return load_file(file_key[0])
+
+    @functools.wraps(load_file)
+    def _load(path):
+        file_stat = os.stat(path)
+        return _load_cached((path, file_stat.st_mtime_ns, file_stat.st_size))
+
+    return _load
+
+
+@_cache_while_unchanged
 def _bib2html(bibliography):
+    """Parse a BibTeX file and format each of its entries as html."""
+    # pybtex already reads the whole file with a single read() before lexing it,
+    # and parse_file keeps the file name in parsing error messages
     parser = bibtex.Parser()
     bibliography = parser.parse_file(bibliography)
     formatted_bib = APA.format_bibliography(bibliography)
-    bibliography_str = "".join(f"<li>{entry.text.render(HTML)}</li>" for entry in formatted_bib)
-    return bibliography_str, bibliography
+    # The report template writes out the list items, so keep the entries separate
+    bibliography_html = tuple(entry.text.render(HTML) for entry in formatted_bib)
+    return bibliography_html, bibliography
+
+
+@_cache_while_unchanged
+def _load_report_json(path):
+    """Load a json file used in the report."""
+    return load_json(path)
 
 
 def _cite2html(bibliography, citekey):
-    # Make a list of citekeys and separete double citations
-    citekey_list = citekey.split(",") if "," in citekey else [citekey]
+    entries = bibliography.entries
+    citations = []
 
-    for idx, key in enumerate(citekey_list):
-        # Get first author
-        first_author = bibliography.entries[key].persons["author"][0]
+    # Separate double citations
+    for key in citekey.split(","):
+        entry = entries[key]
 
-        # Keep surname only (whatever is before the comma, if there is a comma)
-        if "," in str(first_author):
-            first_author = str(first_author).split(",")[0]
+        # Get first author, keeping surname only (whatever is before the comma, if any)
+        first_author = str(entry.persons["author"][0]).split(",", 1)[0]
 
         # Get publication year
-        pub_year = bibliography.entries[key].fields["year"]
+        pub_year = entry.fields["year"]
 
-        # Return complete citation
-        if idx == 0:
-            citation = f"{first_author} et al. {pub_year}"
-        else:
-            citation += f", {first_author} et al. {pub_year}"
+        citations.append(f"{first_author} et al. {pub_year}")
 
-    return citation
+    # Return complete citation
+    return ", ".join(citations)
 
 
 def _inline_citations(text, bibliography):
-    # Find all \citep
-    matches = re.finditer(r"\\citep{(.*?)}", text)
-    citations = [(match.start(), match.group(1)) for match in matches]
-
-    updated_text = text
-
-    for citation in citations:
-        citekey = citation[1]
-        matched_string = "\\citep{" + citekey + "}"
-
-        # Convert citation form latex to html
-        html_citation = f"({_cite2html(bibliography, citekey)})"
-        updated_text = updated_text.replace(matched_string, html_citation, 1)
-
-    return updated_text
-
-
-def _get_template_env():
-    """Create and return Jinja2 environment with template directory."""
-    resource_path = Path(__file__).resolve().parent.joinpath("data", "html")
-
-    # Standard Jinja2 environment - no need for special configuration now
-    template_env = Environment(loader=FileSystemLoader(str(resource_path)))
-    return template_env
-
-
-def _generate_buttons(out_dir, io_generator):
-    images_list = [img for img in os.listdir(out_dir) if ".svg" in img]
-    optcom_nogsr_disp = "none"
-    optcom_name = ""
-    if f"{io_generator.prefix}carpet_optcom_nogsr.svg" in images_list:
-        optcom_nogsr_disp = "block"
-        optcom_name = "before MIR"
-
-    denoised_mir_disp = "none"
-    denoised_name = ""
-    if f"{io_generator.prefix}carpet_denoised_mir.svg" in images_list:
-        denoised_mir_disp = "block"
-        denoised_name = "before MIR"
-
-    accepted_mir_disp = "none"
-    accepted_name = ""
-    if f"{io_generator.prefix}carpet_accepted_mir.svg" in images_list:
-        accepted_mir_disp = "block"
-        accepted_name = "before MIR"
-
-    template_env = _get_template_env()
-    template = template_env.get_template("report_carpet_buttons_template.html")
-
-    buttons_html = template.render(
-        optcomdisp=optcom_nogsr_disp,
-        denoiseddisp=denoised_mir_disp,
-        accepteddisp=accepted_mir_disp,
-        optcomname=optcom_name,
-        denoisedname=denoised_name,
-        acceptedname=accepted_name,
+    # The same references are usually cited several times, so convert each citekey once
+    html_citations = {}
+
+    def _replace(match):
+        citekey = match.group(1)
+        if citekey not in html_citations:
+            html_citations[citekey] = f"({_cite2html(bibliography, citekey)})"
+        return html_citations[citekey]
+
+    # Convert every \citep{...} from latex to html in a single pass over the text
+    return _CITEP_RE.sub(_replace, text)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_template(name):
+    """Load and compile a report template, caching it for the rest of the process."""
+    _TEMPLATE_ENV.bytecode_cache = _get_bytecode_cache()
+    return _TEMPLATE_ENV.get_template(name)
+
+
+def _generate_buttons(figure_files, io_generator):
+    # Carpet plots that are only generated when MIR is run, with the template variable prefix
+    mir_carpets = (
+        ("carpet_optcom_nogsr.svg", "optcom"),
+        ("carpet_denoised_mir.svg", "denoised"),
+        ("carpet_accepted_mir.svg", "accepted"),
     )
 
+    buttons = {}
+    for carpet_filename, key in mir_carpets:
+        carpet_exists = f"{io_generator.prefix}{carpet_filename}" in figure_files
+        buttons[f"{key}disp"] = "block" if carpet_exists else "none"
+        buttons[f"{key}name"] = "before MIR" if carpet_exists else ""
+
+    template = _get_template("report_carpet_buttons_template.html")
+
+    buttons_html = template.render(buttons)
+
     return buttons_html
 
 
-def _update_template_bokeh(bokeh_id, info_table, about, prefix, references, bokeh_js, buttons):
+def _update_template_bokeh(
+    bokeh_id, info_table, about, prefix, references, bokeh_js, buttons, figure_files
+):
     """
     Populate a report with content.
 
@@ -138,6 +199,8 @@ def _update_template_bokeh(bokeh_id, info_table, about, prefix, references, boke
         Javascript created by bokeh.embed.components
     buttons : str
         HTML div created by _generate_buttons()
+    figure_files : set of str
+        Names of the SVG files in the figures directory
 
     Returns
     -------
@@ -146,19 +209,12 @@ def _update_template_bokeh(bokeh_id, info_table, about, prefix, references, boke
     # Initial carpet plot (default one)
     initial_carpet = f"./figures/{prefix}carpet_optcom.svg"
 
-    # Get the figures directory - relative to the directory containing the references file
-    base_dir = os.path.dirname(references)
-    figures_dir = os.path.join(base_dir, "figures")
-
-    # List all files in the figures directory
-    files_in_figures = os.listdir(figures_dir)
-
     # Adaptive mask image
     adaptive_mask_filename = f"{prefix}adaptive_mask.svg"
     adaptive_mask = f"./figures/{adaptive_mask_filename}"
-    adaptive_mask_exists = adaptive_mask_filename in files_in_figures
+    adaptive_mask_exists = adaptive_mask_filename in figure_files
     LGR.info(
-        f"Checking for adaptive mask: {adaptive_mask_filename}, exists: {adaptive_mask_exists}"
+        "Checking for adaptive mask: %s, exists: %s", adaptive_mask_filename, adaptive_mask_exists
     )
 
     # Check for T2* images
@@ -180,19 +236,13 @@ def _update_template_bokeh(bokeh_id, info_table, about, prefix, references, boke
     rmse_timeseries = f"./figures/{rmse_timeseries_filename}"
 
     # Check if each set of images exists
-    t2star_exists = (
-        t2star_brain_filename in files_in_figures and t2star_histogram_filename in files_in_figures
-    )
+    t2star_exists = {t2star_brain_filename, t2star_histogram_filename} <= figure_files
+    s0_exists = {s0_brain_filename, s0_histogram_filename} <= figure_files
+    rmse_exists = {rmse_brain_filename, rmse_timeseries_filename} <= figure_files
 
-    s0_exists = s0_brain_filename in files_in_figures and s0_histogram_filename in files_in_figures
-
-    rmse_exists = (
-        rmse_brain_filename in files_in_figures and rmse_timeseries_filename in files_in_figures
-    )
-
-    LGR.info(f"T2* files exist: {t2star_exists}")
-    LGR.info(f"S0 files exist: {s0_exists}")
-    LGR.info(f"RMSE files exist: {rmse_exists}")
+    LGR.info("T2* files exist: %s", t2star_exists)
+    LGR.info("S0 files exist: %s", s0_exists)
+    LGR.info("RMSE files exist: %s", rmse_exists)
 
     # Convert bibtex to html
     references, bibliography = _bib2html(references)
@@ -200,34 +250,35 @@ def _update_template_bokeh(bokeh_id, info_table, about, prefix, references, boke
     # Update inline citations
     about = _inline_citations(about, bibliography)
 
-    template_env = _get_template_env()
-    body_template = template_env.get_template("report_body_template.html")
-
-    body = body_template.render(
-        content=bokeh_id,
-        info=info_table,
-        about=about,
-        prefix=prefix,
-        initialCarpet=initial_carpet,
-        adaptiveMask=adaptive_mask,
-        adaptiveMaskExists=adaptive_mask_exists,
-        t2starBrainPlot=t2star_brain,
-        t2starHistogram=t2star_histogram,
-        t2starExists=t2star_exists,
-        s0BrainPlot=s0_brain,
-        s0Histogram=s0_histogram,
-        s0Exists=s0_exists,
-        rmseBrainPlot=rmse_brain,
-        rmseTimeseries=rmse_timeseries,
-        rmseExists=rmse_exists,
-        references=references,
-        javascript=bokeh_js,
-        buttons=buttons,
-    )
+    body_template = _get_template("report_body_template.html")
+
+    body_context = {
+        "content": bokeh_id,
+        "info": info_table,
+        "about": about,
+        "prefix": prefix,
+        "initialCarpet": initial_carpet,
+        "adaptiveMask": adaptive_mask,
+        "adaptiveMaskExists": adaptive_mask_exists,
+        "t2starBrainPlot": t2star_brain,
+        "t2starHistogram": t2star_histogram,
+        "t2starExists": t2star_exists,
+        "s0BrainPlot": s0_brain,
+        "s0Histogram": s0_histogram,
+        "s0Exists": s0_exists,
+        "rmseBrainPlot": rmse_brain,
+        "rmseTimeseries": rmse_timeseries,
+        "rmseExists": rmse_exists,
+        "references": references,
+        "javascript": bokeh_js,
+        "buttons": buttons,
+    }
+
+    body = body_template.render(body_context)
     return body
 
 
-def _save_as_html(body):
+def _save_as_html(body, out_file):
     """
     Save an HTML report out to a file.
 
@@ -235,13 +286,15 @@ def _save_as_html(body):
     ----------
     body : str
         Body for HTML report with embedded figures
+    out_file : str
+        Path to the HTML report file
     """
-    template_env = _get_template_env()
-    head_template = template_env.get_template("report_head_template.html")
+    head_template = _get_template("report_head_template.html")
 
-    html = head_template.render(version=__version__, bokehversion=bokehversion, body=body)
-
-    return html
+    # Write the rendered report to the file as it is generated, encoded in UTF-8
+    head_template.stream(version=__version__, bokehversion=bokehversion, body=body).dump(
+        out_file, encoding="utf-8"
+    )
 
 
 def _generate_info_table(info_dict):
@@ -249,8 +302,7 @@ def _generate_info_table(info_dict):
     info_dict = info_dict["GeneratedBy"][0]
     node_dict = info_dict["Node"]
 
-    template_env = _get_template_env()
-    info_template = template_env.get_template("report_info_table_template.html")
+    info_template = _get_template("report_info_table_template.html")
 
     info_html = info_template.render(
         command=info_dict["Command"],
@@ -267,6 +319,55 @@ def _generate_info_table(info_dict):
     return info_html
 
 
+def _get_elbow_vals(cross_comp_metrics_dict):
+    """
+    Find the kappa and rho elbows in the cross component metrics.
+
+    Current elbow metrics are kappa_elbow_kundu and rho_elbow_kundu.
+
+    This flexibility means anything that begins [kappa/rho]_elbow will be found and
+    used regardless of the suffix. If more than one metric has the prefix then the
+    alphabetically first one will be used and a warning will be logged.
+
+    Parameters
+    ----------
+    cross_comp_metrics_dict : dict
+        Cross component metrics, as saved in the cross component metrics json
+
+    Returns
+    -------
+    kappa_elbow, rho_elbow : float or None
+        Values of the kappa and rho elbows. None if no metric begins with the prefix.
+    """
+    # Bucket the metrics by elbow prefix in a single pass over the metrics
+    elbow_keys = {"kappa_elbow": [], "rho_elbow": []}
+    for key in cross_comp_metrics_dict:
+        for elbow_prefix, prefix_keys in elbow_keys.items():
+            if key.startswith(elbow_prefix):
+                prefix_keys.append(key)
+
+    elbows = []
+    for elbow_prefix, prefix_keys in elbow_keys.items():
+        prefix_keys.sort()
+        if len(prefix_keys) == 0:
+            LGR.warning(
+                f"No {elbow_prefix} saved in cross_component_metrics so not displaying in report"
+            )
+            elbows.append(None)
+            continue
+
+        if len(prefix_keys) > 1:
+            LGR.warning(
+                "More than one key saved in cross_component_metrics begins with "
+                f"{elbow_prefix}. The lines on the plots will be for {prefix_keys[0]} "
+                f"NOT {prefix_keys[1:]}"
+            )
+        elbows.append(cross_comp_metrics_dict[prefix_keys[0]])
+
+    kappa_elbow, rho_elbow = elbows
+    return kappa_elbow, rho_elbow
+
+
 def generate_report(io_generator: OutputGenerator) -> None:
     """Generate an HTML report.
 
@@ -279,10 +380,9 @@ def generate_report(io_generator: OutputGenerator) -> None:
     -----
     This writes out an HTML report to a file.
     """
-    # Load the component time series
+    # Get the number of components from the header of the component time series
     comp_ts_path = io_generator.get_name("ICA mixing tsv")
-    comp_ts_df = pd.read_csv(comp_ts_path, sep="\t", encoding="utf=8")
-    n_vols, n_comps = comp_ts_df.shape
+    n_comps = len(pd.read_csv(comp_ts_path, sep="\t", nrows=0, encoding="utf-8").columns)
 
     # Load the component table
     comptable_path = io_generator.get_name("ICA metrics tsv")
@@ -290,45 +390,9 @@ def generate_report(io_generator: OutputGenerator) -> None:
 
     # Load the cross component metrics, including the kappa & rho elbows
     cross_component_metrics_path = io_generator.get_name("ICA cross component metrics json")
-    cross_comp_metrics_dict = load_json(cross_component_metrics_path)
-
-    def get_elbow_val(elbow_prefix):
-        """
-        Find cross component metrics that begin with elbow_prefix and output the value.
-
-        Current prefixes are kappa_elbow_kundu and rho_elbow_kundu.
-
-        This flexibility means anything that begins [kappa/rho]_elbow will be found and
-        used regardless of the suffix. If more than one metric has the prefix then the
-        alphabetically first one will be used and a warning will be logged.
-
-        Parameters
-        ----------
-        elbow_prefix : str
-            The prefix to look for in the cross component metrics
-        """
-        elbow_keys = [k for k in cross_comp_metrics_dict.keys() if elbow_prefix in k]
-        elbow_keys.sort()
-        if len(elbow_keys) == 0:
-            LGR.warning(
-                f"No {elbow_prefix} saved in cross_component_metrics so not displaying in report"
-            )
-            return None
-        elif len(elbow_keys) == 1:
-            return cross_comp_metrics_dict[elbow_keys[0]]
-        else:
-            printed_key = elbow_keys[0]
-            unprinted_keys = elbow_keys[1:]
-
-            LGR.warning(
-                "More than one key saved in cross_component_metrics begins with "
-                f"{elbow_prefix}. The lines on the plots will be for {printed_key} "
-                f"NOT {unprinted_keys}"
-            )
-            return cross_comp_metrics_dict[printed_key]
+    cross_comp_metrics_dict = _load_report_json(cross_component_metrics_path)
 
-    kappa_elbow = get_elbow_val("kappa_elbow")
-    rho_elbow = get_elbow_val("rho_elbow")
+    kappa_elbow, rho_elbow = _get_elbow_vals(cross_comp_metrics_dict)
 
     # Create kappa rho plot
     kappa_rho_plot = df._create_kr_plt(comptable_cds, kappa_elbow=kappa_elbow, rho_elbow=rho_elbow)
@@ -383,18 +447,24 @@ def generate_report(io_generator: OutputGenerator) -> None:
     # Embed for reporting and save out HTML
     kr_script, kr_div = embed.components(app)
 
+    # List the SVG figures once, for both the carpet buttons and the figure sections.
+    # Component maps are PNGs and are loaded by the report itself, so they are skipped.
+    with os.scandir(opj(io_generator.out_dir, "figures")) as entries:
+        figure_files = frozenset(entry.name for entry in entries if entry.name.endswith(".svg"))
+
     # Generate html of buttons (only for images that were generated)
-    buttons_html = _generate_buttons(opj(io_generator.out_dir, "figures"), io_generator)
+    buttons_html = _generate_buttons(figure_files, io_generator)
 
     # Read in relevant methods
-    with open(opj(io_generator.out_dir, f"{io_generator.prefix}report.txt"), "r+") as f:
+    report_path = opj(io_generator.out_dir, f"{io_generator.prefix}report.txt")
+    with open(report_path, "r", encoding="utf-8") as f:
         about = f.read()
 
     references = opj(io_generator.out_dir, f"{io_generator.prefix}references.bib")
 
     # Read info table
     data_descr_path = io_generator.get_name("data description json")
-    data_descr_dict = load_json(data_descr_path)
+    data_descr_dict = _load_report_json(data_descr_path)
 
     # Create info table
     info_table = _generate_info_table(data_descr_dict)
@@ -407,7 +477,6 @@ def generate_report(io_generator: OutputGenerator) -> None:
         prefix=io_generator.prefix,
         bokeh_js=kr_script,
         buttons=buttons_html,
+        figure_files=figure_files,
     )
-    html = _save_as_html(body)
-    with open(opj(io_generator.out_dir, f"{io_generator.prefix}tedana_report.html"), "wb") as f:
-        f.write(html.encode("utf-8"))
+    _save_as_html(body, opj(io_generator.out_dir, f"{io_generator.prefix}tedana_report.html"))
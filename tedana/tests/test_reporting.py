@@ -1,8 +1,13 @@
 """Tests for tedana.reporting."""
 
+import os
+
 import numpy as np
+import pytest
+from pybtex.database.input import bibtex
 
 from tedana import reporting
+from tedana.reporting import html_report
 from tedana.tests.test_external_metrics import sample_mixing_matrix
 from tedana.tests.test_selection_utils import sample_selector
 
@@ -70,3 +75,121 @@ def test_calculate_rejected_components_impact_no_acc():
     assert np.isnan(
         selector.cross_component_metrics_["total_var_exp_rejected_components_on_accepted"]
     )
+
+
+def test_get_template_cached():
+    """Templates are only loaded and compiled once per process."""
+    template = html_report._get_template("report_head_template.html")
+    assert html_report._get_template("report_head_template.html") is template
+
+
+def test_inline_citations():
+    """Each \\citep{} is replaced with a short html citation, duplicates included."""
+    bibliography = bibtex.Parser().parse_string("""
+        @article{first2020, author = {First, Ann and Other, Bob}, year = {2020}}
+        @article{second2021, author = {Second, Cat}, year = {2021}}
+        """)
+    text = "A \\citep{first2020}. B \\citep{first2020,second2021}. C \\citep{first2020}."
+    assert html_report._inline_citations(text, bibliography) == (
+        "A (First et al. 2020). B (First et al. 2020, Second et al. 2021). "
+        "C (First et al. 2020)."
+    )
+
+
+@pytest.mark.parametrize(
+    "loader, file_name, contents, get_value",
+    [
+        (
+            html_report._bib2html,
+            "references.bib",
+            "@article{first2020, author = {First, Ann}, title = {T}, journal = {J}, "
+            "year = {VALUE}}",
+            lambda loaded: loaded[1].entries["first2020"].fields["year"],
+        ),
+        (
+            html_report._load_report_json,
+            "desc-ICACrossComponent_metrics.json",
+            '{"kappa_elbow_kundu": "VALUE"}',
+            lambda loaded: loaded["kappa_elbow_kundu"],
+        ),
+    ],
+)
+def test_report_file_cache(tmp_path, loader, file_name, contents, get_value):
+    """Report input files are only loaded again once their modification time or size changes."""
+    report_file = tmp_path / file_name
+    mtime_ns = os.stat(tmp_path).st_mtime_ns
+
+    report_file.write_text(contents.replace("VALUE", "2020"))
+    os.utime(report_file, ns=(mtime_ns, mtime_ns))
+    loaded = loader(str(report_file))
+    assert get_value(loaded) == "2020"
+    assert loader(str(report_file)) is loaded
+
+    # Same size and modification time, so the cached output is still used
+    report_file.write_text(contents.replace("VALUE", "2021"))
+    os.utime(report_file, ns=(mtime_ns, mtime_ns))
+    assert loader(str(report_file)) is loaded
+
+    # Same size with a new modification time
+    os.utime(report_file, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    assert get_value(loader(str(report_file))) == "2021"
+
+    # New size with the same modification time
+    report_file.write_text(contents.replace("VALUE", "20222"))
+    os.utime(report_file, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    assert get_value(loader(str(report_file))) == "20222"
+
+
+def test_get_template_missing_bytecode_cache(tmp_path, monkeypatch):
+    """Templates still render when the bytecode cache directory disappears."""
+    cache_dir = tmp_path / "jinja2_cache"
+    cache_dir.mkdir()
+    bytecode_cache = html_report._ReportBytecodeCache(str(cache_dir))
+    monkeypatch.setattr(html_report, "_get_bytecode_cache", lambda: bytecode_cache)
+    monkeypatch.setattr(html_report._TEMPLATE_ENV, "bytecode_cache", None)
+    html_report._get_template.cache_clear()
+    html_report._TEMPLATE_ENV.cache.clear()
+
+    cache_dir.rmdir()
+    template = html_report._get_template("report_head_template.html")
+    assert "body text" in template.render(version="0", bokehversion="0", body="body text")
+    assert html_report._TEMPLATE_ENV.bytecode_cache is bytecode_cache
+
+
+def test_get_elbow_vals_one_key(caplog):
+    """A single metric beginning with each elbow prefix is used without warnings."""
+    kappa_elbow, rho_elbow = html_report._get_elbow_vals(
+        {"kappa_elbow_kundu": 1.0, "rho_elbow_kundu": 2.0, "n_echos": 3}
+    )
+    assert (kappa_elbow, rho_elbow) == (1.0, 2.0)
+    assert "cross_component_metrics" not in caplog.text
+
+
+def test_get_elbow_vals_no_key(caplog):
+    """A missing elbow is returned as None and logged."""
+    kappa_elbow, rho_elbow = html_report._get_elbow_vals({"kappa_elbow_kundu": 1.0})
+    assert kappa_elbow == 1.0
+    assert rho_elbow is None
+    assert "No rho_elbow saved in cross_component_metrics" in caplog.text
+
+
+def test_get_elbow_vals_several_keys(caplog):
+    """The alphabetically first metric is used when several begin with an elbow prefix."""
+    kappa_elbow, _ = html_report._get_elbow_vals(
+        {"kappa_elbow_zzz": 3.0, "kappa_elbow_kundu": 1.0, "rho_elbow_kundu": 2.0}
+    )
+    assert kappa_elbow == 1.0
+    assert "More than one key saved in cross_component_metrics begins with kappa_elbow" in (
+        caplog.text
+    )
+    assert "kappa_elbow_zzz" in caplog.text
+
+
+def test_get_elbow_vals_prefix_not_at_start(caplog):
+    """Metrics that only contain an elbow prefix are not used."""
+    kappa_elbow, rho_elbow = html_report._get_elbow_vals(
+        {"max_kappa_elbow": 5.0, "kappa_elbow_kundu": 1.0, "old_rho_elbow": 6.0}
+    )
+    assert kappa_elbow == 1.0
+    assert rho_elbow is None
+    assert "More than one key" not in caplog.text
@@ -540,13 +540,13 @@ def ica_reclassify_workflow(
     with open(repname) as fo:
         report = [line.rstrip() for line in fo.readlines()]
         report = " ".join(report)
-    with open(repname, "w") as fo:
+    with open(repname, "w", encoding="utf-8") as fo:
         fo.write(report)
 
     # Collect BibTeX entries for cited papers
     references = get_description_references(report)
 
-    with open(bibtex_file, "w") as fo:
+    with open(bibtex_file, "w", encoding="utf-8") as fo:
         fo.write(references)
 
     if not no_reports:
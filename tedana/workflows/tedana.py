@@ -1065,13 +1065,13 @@ def tedana_workflow(
         # Double-spaces reflect new paragraphs
         report = report.replace("  ", "\n\n")
 
-    with open(repname, "w") as fo:
+    with open(repname, "w", encoding="utf-8") as fo:
         fo.write(report)
 
     # Collect BibTeX entries for cited papers
     references = get_description_references(report)
 
-    with open(bibtex_file, "w") as fo:
+    with open(bibtex_file, "w", encoding="utf-8") as fo:
         fo.write(references)
 
     if not no_reports: